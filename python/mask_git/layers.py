@@ -47,7 +47,7 @@ def _l2_normalize(x, axis=None, eps=1e-12):
     return x * lax.rsqrt((x * x).sum(axis=axis, keepdims=True) + eps)
 
 
-def get_norm_layer(train, dtype, norm_type='BN'):
+def get_norm_layer(train, dtype, norm_type='BN', param_dtype=jnp.float32):
     """Normalization layer."""
     if norm_type == 'BN':
         norm_fn = functools.partial(
@@ -57,16 +57,80 @@ def get_norm_layer(train, dtype, norm_type='BN'):
             epsilon=1e-5,
             axis_name=None,
             axis_index_groups=None,
-            dtype=jnp.float32)
+            dtype=jnp.float32,
+            param_dtype=param_dtype)
     elif norm_type == 'LN':
-        norm_fn = functools.partial(nn.LayerNorm, dtype=dtype)
+        norm_fn = functools.partial(
+            nn.LayerNorm, dtype=dtype, param_dtype=param_dtype)
     elif norm_type == 'GN':
-        norm_fn = functools.partial(nn.GroupNorm, dtype=dtype)
+        norm_fn = functools.partial(
+            nn.GroupNorm, dtype=dtype, param_dtype=param_dtype)
     else:
         raise NotImplementedError
     return norm_fn
 
 
+class NormAct(nn.Module):
+    """Normalization layer followed by an activation."""
+    norm_fn: Any
+    activation_fn: Any
+
+    @nn.compact
+    def __call__(self, x):
+        return self.activation_fn(self.norm_fn()(x))
+
+
+class GroupNormAct(nn.Module):
+    """GroupNorm followed by an activation.
+
+    The mean and the mean of squares are sibling reductions over the same
+    input, which XLA fuses into one pass, and the scale, shift and activation
+    are applied in a single elementwise pass in float32.
+    """
+    activation_fn: Any
+    num_groups: int = 32
+    epsilon: float = 1e-6
+    dtype: Dtype = jnp.float32
+    param_dtype: Dtype = jnp.float32
+
+    @nn.compact
+    def __call__(self, x):
+        channels = x.shape[-1]
+        if channels % self.num_groups != 0:
+            raise ValueError(
+                f'Number of groups ({self.num_groups}) does not divide the '
+                f'number of channels ({channels}).')
+        scale = self.param(
+            'scale', nn.initializers.ones, (channels,), self.param_dtype)
+        bias = self.param(
+            'bias', nn.initializers.zeros, (channels,), self.param_dtype)
+        grouped = jnp.reshape(
+            x.astype(jnp.float32),
+            x.shape[:-1] + (self.num_groups, channels // self.num_groups))
+        axes = tuple(range(1, grouped.ndim - 2)) + (grouped.ndim - 1,)
+        mean = jnp.mean(grouped, axis=axes, keepdims=True)
+        mean2 = jnp.mean(grouped * grouped, axis=axes, keepdims=True)
+        var = jnp.maximum(mean2 - mean * mean, 0.0)
+        y = (grouped - mean) * lax.rsqrt(var + self.epsilon)
+        y = jnp.reshape(y, x.shape) * scale + bias
+        return self.activation_fn(y).astype(self.dtype)
+
+
+def get_norm_act_layer(train, dtype, activation_fn, norm_type='BN',
+                       param_dtype=jnp.float32):
+    """Normalization layer followed by an activation."""
+    if norm_type == 'GN':
+        return functools.partial(
+            GroupNormAct,
+            activation_fn=activation_fn,
+            dtype=dtype,
+            param_dtype=param_dtype)
+    norm_fn = get_norm_layer(
+        train=train, dtype=dtype, norm_type=norm_type, param_dtype=param_dtype)
+    return functools.partial(
+        NormAct, norm_fn=norm_fn, activation_fn=activation_fn)
+
+
 def tensorflow_style_avg_pooling(x, window_shape, strides, padding: str):
     """Avg pooling as done by TF (Flax layer gives different results).
 
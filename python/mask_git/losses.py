@@ -42,12 +42,49 @@ def squared_euclidean_distance(a: jnp.ndarray,
     return d
 
 
-def entropy_loss(affinity, loss_type="softmax", temperature=1.0):
-    """Calculates the entropy loss."""
+def vq_latent_loss(quantized, x, commitment_cost=0.25):
+    """Calculates the VQ codebook and commitment losses in one pass.
+
+    (sg(q) - x)^2 and (q - sg(x))^2 have the same value, so it is computed
+    once. Scaling the gradient that reaches x by commitment_cost gives the
+    returned loss the gradients of e_latent_loss + q_latent_loss.
+
+    Returns:
+      loss: e_latent_loss + q_latent_loss, with gradients.
+      e_latent_loss: the commitment loss, without gradients.
+      q_latent_loss: the codebook loss, without gradients.
+    """
+    x_commit = commitment_cost * x + (
+        1 - commitment_cost) * jax.lax.stop_gradient(x)
+    latent_loss = jnp.mean((quantized - x_commit)**2)
+    q_latent_loss = jax.lax.stop_gradient(latent_loss)
+    e_latent_loss = q_latent_loss * commitment_cost
+    loss = latent_loss + e_latent_loss
+    return loss, e_latent_loss, q_latent_loss
+
+
+def entropy_loss(affinity,
+                 loss_type="softmax",
+                 temperature=1.0,
+                 precomputed_max=None):
+    """Calculates the entropy loss.
+
+    If the caller already has `affinity.max(axis=-1)`, it can be passed as
+    `precomputed_max` to skip the max reduction inside the softmax.
+    """
     flat_affinity = affinity.reshape(-1, affinity.shape[-1])
     flat_affinity /= temperature
-    probs = jax.nn.softmax(flat_affinity, axis=-1)
-    log_probs = jax.nn.log_softmax(flat_affinity + 1e-5, axis=-1)
+    if precomputed_max is None:
+        probs = jax.nn.softmax(flat_affinity, axis=-1)
+        log_probs = jax.nn.log_softmax(flat_affinity + 1e-5, axis=-1)
+    else:
+        # Like jax.nn.softmax, the shift carries no gradient.
+        shifted = flat_affinity - jax.lax.stop_gradient(
+            precomputed_max).reshape(-1, 1) / temperature
+        exp_shifted = jnp.exp(shifted)
+        sum_exp = jnp.sum(exp_shifted, axis=-1, keepdims=True)
+        probs = exp_shifted / sum_exp
+        log_probs = shifted - jnp.log(sum_exp)
     if loss_type == "softmax":
         target_probs = probs
     elif loss_type == "argmax":
@@ -1,10 +1,12 @@
 import argparse
+import functools
 import cv2
 from networks import VQVAE
 import jax
 import jax.numpy as jnp
 from jax import random, jit
 import optax
+from flax import jax_utils
 from flax.training import train_state, checkpoints
 from data_loader import DataLoader
 import os
@@ -22,23 +24,42 @@ def parse_args():
     return parser.parse_args()
 
 
-def loss_fn(params, batch):
+def loss_fn(params, batch, mask):
+    """This device's share of the mean loss over the real images."""
     reconstructions = model.apply(params, batch)
-    loss = jnp.mean((reconstructions - batch) ** 2)
+    image_loss = jnp.mean((reconstructions - batch) ** 2, axis=(1, 2, 3))
+    num_images = jax.lax.psum(jnp.sum(mask), axis_name="batch")
+    loss = jnp.sum(image_loss * mask) / num_images
     return loss
 
 
-@jit
-def train_step(state, batch):
+@functools.partial(jax.pmap, axis_name="batch", donate_argnums=(0,))
+def train_step(state, batch, mask):
     grad_fn = jax.value_and_grad(loss_fn)
-    loss, grads = grad_fn(state.params, batch)
+    loss, grads = grad_fn(state.params, batch, mask)
+    grads = jax.lax.psum(grads, axis_name="batch")
+    loss = jax.lax.psum(loss, axis_name="batch")
     state = state.apply_gradients(grads=grads)
     return state, loss
 
 
+def shard(batch):
+    """Splits the batch over the local devices.
+
+    A batch that does not divide evenly is padded with zero images, which
+    are 0 in the returned mask so that they do not count in the loss.
+    """
+    n = jax.local_device_count()
+    num_pad = -batch.shape[0] % n
+    mask = jnp.concatenate([jnp.ones(batch.shape[0]), jnp.zeros(num_pad)])
+    batch = jnp.concatenate(
+        [batch, jnp.zeros((num_pad,) + batch.shape[1:], batch.dtype)])
+    return batch.reshape((n, -1) + batch.shape[1:]), mask.reshape((n, -1))
+
+
 @jit
 def test_step(state, batch):
-    return model.apply(state.params, batch)
+    return eval_model.apply(state.params, batch)
 
 
 if __name__ == "__main__":
@@ -46,14 +67,20 @@ if __name__ == "__main__":
     train_data_dir = f"{args.data_dir}/train"
     test_data_dir = f"{args.data_dir}/test"
 
-    batch_size = 100
+    # Keep every full batch evenly divisible over the devices; only the
+    # last batch of an epoch needs padding.
+    per_device_batch_size = max(1, 100 // jax.local_device_count())
+    batch_size = per_device_batch_size * jax.local_device_count()
     train_loader = DataLoader(train_data_dir, batch_size)
     test_loader = DataLoader(test_data_dir, batch_size, max_num=5)
     train_loader_for_test = DataLoader(train_data_dir, batch_size, max_num=5)
 
-    model = VQVAE(train=True)
+    model = VQVAE(train=True, axis_name="batch")
+    # train is a module attribute, so the eval model traces only the
+    # inference path. It is also used for init, which runs outside pmap.
+    eval_model = VQVAE(train=False)
     rng = random.PRNGKey(0)
-    params = model.init(rng, jnp.ones((1, 96, 96, 3)))
+    params = jit(eval_model.init)(rng, jnp.ones((1, 96, 96, 3)))
 
     num_epochs = args.epoch
     step_num_per_epoch = train_loader.step_num_per_epoch()
@@ -78,6 +105,7 @@ if __name__ == "__main__":
         params=params,
         tx=optimizer,
     )
+    state = jax_utils.replicate(state)
 
     now = datetime.now()
     datetime_str = now.strftime("%Y%m%d-%H%M%S")
@@ -91,18 +119,21 @@ if __name__ == "__main__":
         loss_sum = 0
         loss_num = 0
         for batch in train_loader:
-            state, loss = train_step(state, batch)
-            loss_sum += batch.shape[0] * loss
-            loss_num += batch.shape[0]
+            num_images = batch.shape[0]
+            state, loss = train_step(state, *shard(batch))
+            loss = loss[0]
+            loss_sum += num_images * loss
+            loss_num += num_images
             global_step += 1
             writer.add_scalar("train/loss", loss, global_step)
         print(f'Epoch {epoch}, Loss: {loss_sum / loss_num:.4f}')
 
         curr_save_dir = f"{save_dir}/{epoch:04d}"
         os.makedirs(curr_save_dir, exist_ok=True)
+        single_state = jax_utils.unreplicate(state)
         for name, loader in zip(["train", "test"], [train_loader_for_test, test_loader]):
             for batch in loader:
-                reconstructions = test_step(state, batch)
+                reconstructions = test_step(single_state, batch)
                 for i, (original, reconstructed) in enumerate(zip(batch, reconstructions)):
                     save_path = f"{curr_save_dir}/reconstruction_{name}_{i:04d}.png"
                     combined_image = np.hstack((original, reconstructed))
@@ -115,4 +146,5 @@ if __name__ == "__main__":
                     writer.add_image(
                         f'test/reconstruction_{name}_{i:04d}', combined_image, global_step=epoch)
 
-    checkpoints.save_checkpoint(ckpt_dir=save_dir, target=state, step=global_step)
+    checkpoints.save_checkpoint(
+        ckpt_dir=save_dir, target=jax_utils.unreplicate(state), step=global_step)
@@ -19,10 +19,13 @@ This tokenizer is a reimplementation of VQGAN [https://arxiv.org/abs/2012.09841]
 with several modifications. The non-local layers are removed from VQGAN for
 faster speed.
 """
+import functools
 from typing import Any
 
 import flax.linen as nn
 import jax
+from jax import lax
+from jax.ad_checkpoint import checkpoint_name
 import jax.numpy as jnp
 import losses
 import layers
@@ -30,24 +33,39 @@ from quantizers import FSQ, FSQ_Level2
 
 
 class ResBlock(nn.Module):
-    """Basic Residual Block."""
+    """Basic Residual Block.
+
+    The compute dtype comes from the conv_fn and norm_act_fn factories.
+    """
     filters: int
-    norm_fn: Any
+    norm_act_fn: Any
     conv_fn: Any
-    dtype: int = jnp.float32
-    activation_fn: Any = nn.relu
     use_conv_shortcut: bool = False
+    grouped_conv: bool = False
 
     @nn.compact
     def __call__(self, x):
         input_dim = x.shape[-1]
         residual = x
-        x = self.norm_fn()(x)
-        x = self.activation_fn(x)
-        x = self.conv_fn(self.filters, kernel_size=(3, 3), use_bias=False)(x)
-        x = self.norm_fn()(x)
-        x = self.activation_fn(x)
+        x = self.norm_act_fn()(x)
         x = self.conv_fn(self.filters, kernel_size=(3, 3), use_bias=False)(x)
+        x = checkpoint_name(x, "conv_out")
+        x = self.norm_act_fn()(x)
+        if (self.grouped_conv and input_dim == self.filters and
+                self.filters >= 512):
+            # Four grouped 3x3 convs followed by a 1x1 conv that mixes the
+            # groups, at about a third of the FLOPs of a dense 3x3 conv.
+            x = self.conv_fn(
+                self.filters,
+                kernel_size=(3, 3),
+                feature_group_count=4,
+                use_bias=False)(x)
+            x = self.conv_fn(
+                self.filters, kernel_size=(1, 1), use_bias=False)(x)
+        else:
+            x = self.conv_fn(
+                self.filters, kernel_size=(3, 3), use_bias=False)(x)
+        x = checkpoint_name(x, "conv_out")
 
         if input_dim != self.filters:
             if self.use_conv_shortcut:
@@ -61,49 +79,106 @@ class ResBlock(nn.Module):
         return x + residual
 
 
+# Only the conv outputs are kept for the backward pass. The norm and
+# activation in between are recomputed, so XLA can fuse them into the conv
+# that consumes them instead of writing them out.
+FusedResBlock = nn.remat(
+    ResBlock,
+    policy=jax.checkpoint_policies.save_only_these_names("conv_out"))
+
+# Saves nothing inside the block; only its input is kept, which for the
+# scanned blocks of a ResBlockStack is the scan carry.
+RematResBlock = nn.remat(
+    ResBlock, policy=jax.checkpoint_policies.nothing_saveable)
+
+
+class ResBlockStack(nn.Module):
+    """Sequence of ResBlocks sharing the same number of filters.
+
+    The blocks that keep the channel count all have the same shape, so they
+    run as one nn.scan instead of being unrolled in Python. Their activations
+    are recomputed in the backward pass.
+    """
+    filters: int
+    num_blocks: int
+    norm_act_fn: Any
+    conv_fn: Any
+    use_conv_shortcut: bool = False
+    grouped_conv: bool = False
+
+    @nn.compact
+    def __call__(self, x):
+        block_args = dict(
+            norm_act_fn=self.norm_act_fn,
+            conv_fn=self.conv_fn,
+            use_conv_shortcut=self.use_conv_shortcut,
+            grouped_conv=self.grouped_conv,
+        )
+        num_blocks = self.num_blocks
+        if x.shape[-1] != self.filters:
+            x = FusedResBlock(self.filters, **block_args)(x)
+            num_blocks -= 1
+        if num_blocks > 0:
+            scan_fn = nn.scan(
+                lambda block, carry, _: (block(carry), None),
+                variable_axes={"params": 0, "batch_stats": 0},
+                split_rngs={"params": True},
+                length=num_blocks)
+            x, _ = scan_fn(RematResBlock(self.filters, **block_args), x, None)
+        return x
+
+
 class Encoder(nn.Module):
     """Encoder Blocks."""
 
     train: bool
-    dtype: int = jnp.float32
+    dtype: int = jnp.bfloat16
 
     def setup(self):
         self.filters = 128
         self.num_res_blocks = 2
         self.channel_multipliers = [1, 1, 2, 2, 4]
         self.embedding_dim = 10
-        self.conv_downsample = False
+        self.conv_downsample = True
         self.norm_type = "GN"
         self.activation_fn = nn.swish
-
-    @nn.compact
-    def __call__(self, x):
-        conv_fn = nn.Conv
-        norm_fn = layers.get_norm_layer(
-            train=self.train, dtype=self.dtype, norm_type=self.norm_type)
-        block_args = dict(
-            norm_fn=norm_fn,
-            conv_fn=conv_fn,
+        self.grouped_conv = False
+        self.conv_fn = functools.partial(
+            nn.Conv,
+            dtype=self.dtype,
+            param_dtype=jnp.float32,
+            precision=lax.Precision.DEFAULT)
+        self.norm_act_fn = layers.get_norm_act_layer(
+            train=self.train,
             dtype=self.dtype,
             activation_fn=self.activation_fn,
+            norm_type=self.norm_type,
+            param_dtype=jnp.float32)
+        self.block_args = dict(
+            norm_act_fn=self.norm_act_fn,
+            conv_fn=self.conv_fn,
             use_conv_shortcut=False,
+            grouped_conv=self.grouped_conv,
         )
-        x = conv_fn(self.filters, kernel_size=(3, 3), use_bias=False)(x)
+
+    @nn.compact
+    def __call__(self, x):
+        x = x.astype(self.dtype)
+        x = self.conv_fn(self.filters, kernel_size=(3, 3), use_bias=False)(x)
         num_blocks = len(self.channel_multipliers)
         for i in range(num_blocks):
             filters = self.filters * self.channel_multipliers[i]
-            for _ in range(self.num_res_blocks):
-                x = ResBlock(filters, **block_args)(x)
+            x = ResBlockStack(
+                filters, self.num_res_blocks, **self.block_args)(x)
             if i < num_blocks - 1:
                 if self.conv_downsample:
-                    x = conv_fn(filters, kernel_size=(4, 4), strides=(2, 2))(x)
+                    x = self.conv_fn(
+                        filters, kernel_size=(4, 4), strides=(2, 2))(x)
                 else:
                     x = layers.dsample(x)
-        for _ in range(self.num_res_blocks):
-            x = ResBlock(filters, **block_args)(x)
-        x = norm_fn()(x)
-        x = self.activation_fn(x)
-        x = conv_fn(self.embedding_dim, kernel_size=(1, 1))(x)
+        x = ResBlockStack(filters, self.num_res_blocks, **self.block_args)(x)
+        x = self.norm_act_fn()(x)
+        x = self.conv_fn(self.embedding_dim, kernel_size=(1, 1))(x)
         return x
 
 
@@ -112,7 +187,8 @@ class Decoder(nn.Module):
 
     train: bool
     output_dim: int = 3
-    dtype: Any = jnp.float32
+    dtype: Any = jnp.bfloat16
+    hard_sigmoid_output: bool = False
 
     def setup(self):
         self.filters = 128
@@ -120,45 +196,129 @@ class Decoder(nn.Module):
         self.channel_multipliers = [1, 1, 2, 2, 4]
         self.norm_type = "GN"
         self.activation_fn = nn.swish
-
-    @nn.compact
-    def __call__(self, x):
-        conv_fn = nn.Conv
-        norm_fn = layers.get_norm_layer(
-            train=self.train, dtype=self.dtype, norm_type=self.norm_type)
-        block_args = dict(
-            norm_fn=norm_fn,
-            conv_fn=conv_fn,
+        self.grouped_conv = False
+        self.conv_fn = functools.partial(
+            nn.Conv,
+            dtype=self.dtype,
+            param_dtype=jnp.float32,
+            precision=lax.Precision.DEFAULT)
+        self.upconv_fn = functools.partial(
+            nn.ConvTranspose,
+            dtype=self.dtype,
+            param_dtype=jnp.float32,
+            precision=lax.Precision.DEFAULT,
+            kernel_init=nn.initializers.variance_scaling(
+                1.0, "fan_in", "normal"))
+        self.norm_act_fn = layers.get_norm_act_layer(
+            train=self.train,
             dtype=self.dtype,
             activation_fn=self.activation_fn,
+            norm_type=self.norm_type,
+            param_dtype=jnp.float32)
+        self.block_args = dict(
+            norm_act_fn=self.norm_act_fn,
+            conv_fn=self.conv_fn,
             use_conv_shortcut=False,
+            grouped_conv=self.grouped_conv,
         )
+
+    @nn.compact
+    def __call__(self, x):
         num_blocks = len(self.channel_multipliers)
         filters = self.filters * self.channel_multipliers[-1]
-        x = conv_fn(filters, kernel_size=(3, 3), use_bias=True)(x)
-        for _ in range(self.num_res_blocks):
-            x = ResBlock(filters, **block_args)(x)
+        x = x.astype(self.dtype)
+        x = self.conv_fn(filters, kernel_size=(3, 3), use_bias=True)(x)
+        x = ResBlockStack(filters, self.num_res_blocks, **self.block_args)(x)
         for i in reversed(range(num_blocks)):
             filters = self.filters * self.channel_multipliers[i]
-            for _ in range(self.num_res_blocks):
-                x = ResBlock(filters, **block_args)(x)
+            x = ResBlockStack(
+                filters, self.num_res_blocks, **self.block_args)(x)
             if i > 0:
-                x = layers.upsample(x, 2)
-                x = conv_fn(filters, kernel_size=(3, 3))(x)
-        x = norm_fn()(x)
-        x = self.activation_fn(x)
-        x = conv_fn(self.output_dim, kernel_size=(3, 3))(x)
-        x = jax.nn.sigmoid(x)
+                x = self.upconv_fn(
+                    filters, kernel_size=(3, 3), strides=(2, 2),
+                    padding="SAME")(x)
+        x = self.norm_act_fn()(x)
+        x = self.conv_fn(self.output_dim, kernel_size=(3, 3))(x)
+        x = x.astype(jnp.float32)
+        if self.hard_sigmoid_output:
+            # Cheaper than sigmoid but not equal to it away from zero, so it
+            # only makes sense for a model trained with this output.
+            x = jnp.clip(x * 0.25 + 0.5, 0.0, 1.0)
+        else:
+            x = jax.nn.sigmoid(x)
         return x
 
 
+def _gather_rows(table: jnp.ndarray, ids: jnp.ndarray,
+                 mode: Any = lax.GatherScatterMode.FILL_OR_DROP
+                 ) -> jnp.ndarray:
+    """Returns table[ids] as a single batched gather along axis 0.
+
+    The default mode fills out-of-range ids with NaN. Pass PROMISE_IN_BOUNDS
+    only for ids known to be valid, e.g. from argmin.
+    """
+    return lax.gather(
+        table,
+        ids[..., None],
+        lax.GatherDimensionNumbers(
+            offset_dims=tuple(range(ids.ndim, ids.ndim + table.ndim - 1)),
+            collapsed_slice_dims=(0,),
+            start_index_map=(0,)),
+        slice_sizes=(1,) + table.shape[1:],
+        mode=mode)
+
+
+def _quantizer_losses(x, quantized, entropy_fn, axis_name=None):
+    """Training losses shared by the codebook quantizers.
+
+    Only called when training, so none of this is traced for inference.
+    entropy_fn(loss_type, temperature) returns the entropy loss and is only
+    called when entropy_loss_ratio is non-zero.
+
+    Only quantizer_loss carries gradients. e_latent_loss and q_latent_loss
+    are gradient-free copies of its commitment and codebook terms, kept for
+    logging; build a training loss from quantizer_loss, not from them.
+    """
+    commitment_cost = 0.25
+    vq_loss, e_latent_loss, q_latent_loss = losses.vq_latent_loss(
+        quantized, x, commitment_cost)
+    entropy_loss = 0.0
+    entropy_loss_ratio = 0.1
+    entropy_temperature = 0.01
+    entropy_loss_type = "softmax"
+    if entropy_loss_ratio != 0:
+        entropy_loss = entropy_fn(
+            entropy_loss_type, entropy_temperature) * entropy_loss_ratio
+    vq_loss = jnp.asarray(vq_loss, jnp.float32)
+    e_latent_loss = jnp.asarray(e_latent_loss, jnp.float32)
+    q_latent_loss = jnp.asarray(q_latent_loss, jnp.float32)
+    entropy_loss = jnp.asarray(entropy_loss, jnp.float32)
+    if axis_name is not None:
+        # Average the codebook statistics over the data-parallel shards so
+        # every device sees the same losses.
+        vq_loss, e_latent_loss, q_latent_loss, entropy_loss = (
+            jax.lax.pmean(
+                (vq_loss, e_latent_loss, q_latent_loss, entropy_loss),
+                axis_name=axis_name))
+    loss = vq_loss + entropy_loss
+    return dict(
+        quantizer_loss=loss,
+        e_latent_loss=e_latent_loss,
+        q_latent_loss=q_latent_loss,
+        entropy_loss=entropy_loss)
+
+
 class VectorQuantizer(nn.Module):
     """Basic vector quantizer."""
     train: bool
-    dtype: int = jnp.float32
+    dtype: int = jnp.bfloat16
+    int8_inference: bool = False
+    axis_name: Any = None
 
     @nn.compact
     def __call__(self, x):
+        if self.int8_inference:
+            return self._int8_call(x)
         codebook_size = 1024
         codebook = self.param(
             "codebook",
@@ -166,71 +326,186 @@ class VectorQuantizer(nn.Module):
                 scale=1.0, mode="fan_in", distribution="uniform"),
             (codebook_size, x.shape[-1]))
         codebook = jnp.asarray(codebook, dtype=self.dtype)
-        distances = jnp.reshape(
-            losses.squared_euclidean_distance(
-                jnp.reshape(x, (-1, x.shape[-1])), codebook),
-            x.shape[:-1] + (codebook_size,))
+        # ||x - c||^2 = ||x||^2 + ||c||^2 - 2<x, c>. The ||x||^2 term is
+        # constant along the codebook axis, so argmin does not need it.
+        codebook2 = jnp.sum(codebook**2, axis=-1)
+        distances = codebook2 - 2 * jnp.einsum(
+            "...d,kd->...k", x, codebook, preferred_element_type=jnp.float32)
         encoding_indices = jnp.argmin(distances, axis=-1)
-        encodings = jax.nn.one_hot(
-            encoding_indices, codebook_size, dtype=self.dtype)
-        quantized = self.quantize(encodings)
+        quantized = _gather_rows(
+            codebook, encoding_indices,
+            mode=lax.GatherScatterMode.PROMISE_IN_BOUNDS)
         result_dict = dict()
         if self.train:
-            commitment_cost = 0.25
-            e_latent_loss = jnp.mean((jax.lax.stop_gradient(quantized) - x) **
-                                     2) * commitment_cost
-            q_latent_loss = jnp.mean((quantized - jax.lax.stop_gradient(x))**2)
-            entropy_loss = 0.0
-            entropy_loss_ratio = 0.1
-            entropy_temperature = 0.01
-            entropy_loss_type = "softmax"
-            if entropy_loss_ratio != 0:
-                entropy_loss = losses.entropy_loss(
+            # The softmax over the codebook axis does not depend on the
+            # ||x||^2 term that distances leave out.
+            result_dict = _quantizer_losses(
+                x, quantized,
+                lambda loss_type, temperature: losses.entropy_loss(
                     -distances,
-                    loss_type=entropy_loss_type,
-                    temperature=entropy_temperature
-                ) * entropy_loss_ratio
-            e_latent_loss = jnp.asarray(e_latent_loss, jnp.float32)
-            q_latent_loss = jnp.asarray(q_latent_loss, jnp.float32)
-            entropy_loss = jnp.asarray(entropy_loss, jnp.float32)
-            loss = e_latent_loss + q_latent_loss + entropy_loss
-            result_dict = dict(
-                quantizer_loss=loss,
-                e_latent_loss=e_latent_loss,
-                q_latent_loss=q_latent_loss,
-                entropy_loss=entropy_loss)
+                    loss_type=loss_type,
+                    temperature=temperature,
+                    precomputed_max=-jnp.min(distances, axis=-1)),
+                axis_name=self.axis_name)
             quantized = x + jax.lax.stop_gradient(quantized - x)
 
         result_dict.update({
-            "encodings": encodings,
             "encoding_indices": encoding_indices,
             "raw": x,
         })
         return quantized, result_dict
 
-    def quantize(self, z: jnp.ndarray) -> jnp.ndarray:
+    def _int8_call(self, x):
+        """Inference path that ranks codewords with the int8 codebook."""
+        if self.train:
+            raise ValueError("int8_inference is only supported with train=False")
+        codebook_q = self.get_variable("int8_codebook", "codebook")
+        scale = self.get_variable("int8_codebook", "scale")
+        x_scale = jnp.max(jnp.abs(x), axis=-1, keepdims=True) / 127.0
+        x_scale = jnp.maximum(x_scale.astype(jnp.float32), 1e-12)
+        x_q = jnp.round(x / x_scale).astype(jnp.int8)
+        xc = lax.dot_general(
+            x_q, codebook_q, (((x_q.ndim - 1,), (1,)), ((), ())),
+            preferred_element_type=jnp.int32)
+        xc = xc.astype(jnp.float32) * x_scale * scale
+        codebook2 = jnp.sum(
+            jnp.square(codebook_q.astype(jnp.float32)), axis=-1) * scale**2
+        distances = codebook2 - 2 * xc
+        encoding_indices = jnp.argmin(distances, axis=-1)
+        in_bounds = lax.GatherScatterMode.PROMISE_IN_BOUNDS
+        quantized = _gather_rows(
+            codebook_q, encoding_indices, mode=in_bounds) * _gather_rows(
+                scale, encoding_indices, mode=in_bounds)[..., None]
+        result_dict = {
+            "encoding_indices": encoding_indices,
+            "raw": x,
+        }
+        return quantized.astype(self.dtype), result_dict
+
+    def quantize_codebook(self):
+        """Stores an int8 copy of the codebook with a float32 scale per row.
+
+        Apply with mutable=["int8_codebook"] and pass the returned variables
+        to a VectorQuantizer with int8_inference=True.
+        """
         codebook = jnp.asarray(
-            self.variables["params"]["codebook"], dtype=self.dtype)
-        return jnp.dot(z, codebook)
+            self.variables["params"]["codebook"], jnp.float32)
+        scale = jnp.max(jnp.abs(codebook), axis=-1) / 127.0
+        scale = jnp.maximum(scale, 1e-12)
+        codebook_q = jnp.round(codebook / scale[:, None]).astype(jnp.int8)
+        self.put_variable("int8_codebook", "codebook", codebook_q)
+        self.put_variable("int8_codebook", "scale", scale)
+
+    def one_hot_encodings(self, ids: jnp.ndarray) -> jnp.ndarray:
+        codebook_size = self.variables["params"]["codebook"].shape[0]
+        return jax.nn.one_hot(ids, codebook_size, dtype=self.dtype)
 
     def get_codebook(self) -> jnp.ndarray:
         return jnp.asarray(self.variables["params"]["codebook"], dtype=self.dtype)
 
     def decode_ids(self, ids: jnp.ndarray) -> jnp.ndarray:
         codebook = self.variables["params"]["codebook"]
-        return jnp.take(codebook, ids, axis=0)
+        # ids may come from callers, so wrap negative ids like jnp.take and
+        # let the default mode fill out-of-range ids with NaN.
+        ids = jnp.where(ids < 0, ids + codebook.shape[0], ids)
+        return _gather_rows(codebook, ids)
+
+
+class ProductQuantizer(nn.Module):
+    """Vector quantizer with one small codebook per subspace.
+
+    The feature dimension is split into num_subspaces chunks and each chunk
+    is quantized against its own subcodebook_size codewords. The chunk ids
+    are packed into one index in base subcodebook_size.
+    """
+    train: bool
+    dtype: int = jnp.bfloat16
+    num_subspaces: int = 5
+    subcodebook_size: int = 16
+    axis_name: Any = None
+
+    @nn.compact
+    def __call__(self, x):
+        if x.shape[-1] % self.num_subspaces != 0:
+            raise ValueError(
+                f"feature dim {x.shape[-1]} is not divisible by "
+                f"num_subspaces={self.num_subspaces}")
+        if (self.subcodebook_size**self.num_subspaces - 1 >
+                jnp.iinfo(jnp.int32).max):
+            raise ValueError(
+                f"subcodebook_size**num_subspaces = "
+                f"{self.subcodebook_size}**{self.num_subspaces} ids do not "
+                f"fit in int32 encoding_indices")
+        sub_dim = x.shape[-1] // self.num_subspaces
+        codebook = self.param(
+            "codebook_pq",
+            jax.nn.initializers.variance_scaling(
+                scale=1.0, mode="fan_in", distribution="uniform"),
+            (self.num_subspaces, self.subcodebook_size, sub_dim))
+        codebook = jnp.asarray(codebook, dtype=self.dtype)
+        x_sub = jnp.reshape(x, x.shape[:-1] + (self.num_subspaces, sub_dim))
+        # Same ||c||^2 - 2<x, c> ranking as VectorQuantizer, per subspace.
+        codebook2 = jnp.sum(codebook**2, axis=-1)
+        distances = codebook2 - 2 * jnp.einsum(
+            "...md,mkd->...mk", x_sub, codebook,
+            preferred_element_type=jnp.float32)
+        sub_indices = jnp.argmin(distances, axis=-1)
+        quantized = self._lookup(codebook, sub_indices)
+        encoding_indices = jnp.sum(sub_indices * self._basis(), axis=-1)
+        result_dict = dict()
+        if self.train:
+            # Each subspace has its own codebook, so its usage entropy is
+            # computed separately.
+            result_dict = _quantizer_losses(
+                x, quantized,
+                lambda loss_type, temperature: jnp.mean(jax.vmap(
+                    lambda d: losses.entropy_loss(
+                        -d,
+                        loss_type=loss_type,
+                        temperature=temperature,
+                        precomputed_max=-jnp.min(d, axis=-1)),
+                    in_axes=-2)(distances)),
+                axis_name=self.axis_name)
+            quantized = x + jax.lax.stop_gradient(quantized - x)
+
+        result_dict.update({
+            "encoding_indices": encoding_indices,
+            "raw": x,
+        })
+        return quantized, result_dict
+
+    def _basis(self) -> jnp.ndarray:
+        return self.subcodebook_size**jnp.arange(self.num_subspaces)
+
+    def _lookup(self, codebook: jnp.ndarray,
+                sub_indices: jnp.ndarray) -> jnp.ndarray:
+        """Gathers and concatenates the codewords of every subspace."""
+        codewords = codebook[jnp.arange(self.num_subspaces), sub_indices]
+        return jnp.reshape(codewords, sub_indices.shape[:-1] + (-1,))
+
+    def get_codebook(self) -> jnp.ndarray:
+        return jnp.asarray(
+            self.variables["params"]["codebook_pq"], dtype=self.dtype)
+
+    def decode_ids(self, ids: jnp.ndarray) -> jnp.ndarray:
+        codebook = self.variables["params"]["codebook_pq"]
+        sub_indices = (ids[..., None] // self._basis()) % self.subcodebook_size
+        return self._lookup(codebook, sub_indices)
 
 
 class VQVAE(nn.Module):
     """VQVAE model."""
     train: bool
-    dtype: int = jnp.float32
+    dtype: int = jnp.bfloat16
     activation_fn: Any = nn.relu
+    axis_name: Any = None
 
     def setup(self):
         """VQVAE setup."""
         # self.quantizer = VectorQuantizer(
-        #     train=self.train, dtype=self.dtype)
+        #     train=self.train, dtype=self.dtype, axis_name=self.axis_name)
+        # self.quantizer = ProductQuantizer(
+        #     train=self.train, dtype=self.dtype, axis_name=self.axis_name)
         # self.quantizer = FSQ(
         #     levels=[3 for _ in range(10)]
         # )